@@ -11,14 +11,16 @@ __version__ = "1.0"
 
 import os
 import sys
+import queue
 import time
+from collections import deque
+from datetime import datetime
+from math import isnan, nan
 
-import numpy as np
 import psutil
 
 from PyQt5 import QtCore, QtGui
 from PyQt5 import QtWidgets as QtWid
-from PyQt5.QtCore import QDateTime
 import pyqtgraph as pg
 
 from dvg_debug_functions import tprint, dprint, print_fancy_traceback as pft
@@ -41,7 +43,7 @@ from dvg_qdeviceio import QDeviceIO
 from dvg_pid_controller import PID_Controller
 
 
-TRY_USING_OPENGL = False
+TRY_USING_OPENGL = True
 if TRY_USING_OPENGL:
     try:
         import OpenGL.GL as gl  # pylint: disable=unused-import
@@ -51,17 +53,20 @@ if TRY_USING_OPENGL:
     else:
         print("OpenGL acceleration: Enabled")
         pg.setConfigOptions(useOpenGL=True)
-        pg.setConfigOptions(antialias=True)
         pg.setConfigOptions(enableExperimental=True)
 
 # Global pyqtgraph configuration
 # pg.setConfigOptions(leftButtonPan=False)
 pg.setConfigOption("foreground", "#EEE")
+pg.setConfigOptions(antialias=False)  # Antialiasing is costly to redraw
 
 # Constants
 DAQ_INTERVAL_MS = 1000  # [ms]
-CHART_INTERVAL_MS = 500  # [ms]
 CHART_HISTORY_TIME = 7200  # [s]
+LOG_FLUSH_INTERVAL = 10  # [s], max. time the log data is held in memory
+LOG_BUFFER_SIZE = 65536  # [chars], flush log data sooner when exceeded
+LOG_MAX_SIZE = 100 << 20  # [chars], start a new log file when exceeded (~MB)
+LOG_BACKUP_COUNT = 5  # Number of full log files to keep next to the current
 
 # Constants PID
 # Tuned for parallel connected heaters, 1x 5W, 1x 10W
@@ -70,16 +75,21 @@ PID_Kp = 4.0
 PID_Ki = 0.003
 PID_V_clamp = 12  # [V], limit output voltage driven by the PID
 
+# Pre-bound format methods of the strings that get built every DAQ update
+FMT_LOG_DATA = "{:.1f}\t{:.2f}\t{:.1f}\t{:.3f}\n".format
+FMT_TITLE = "Interior:  {:.1f} °C,  {:.1f} %".format
+FMT_PID_DEBUG = "Tp={:7.3f}   Ti={:7.3f}   outp={:7.3f}".format
+
 # Show debug info in terminal? Warning: Slow! Do not leave on unintentionally.
 DEBUG = False
 
 
 def get_current_date_time():
-    cur_date_time = QDateTime.currentDateTime()
+    cur_date_time = datetime.now()
     return (
-        cur_date_time.toString("dd-MM-yyyy"),  # Date
-        cur_date_time.toString("HH:mm:ss"),  # Time
-        cur_date_time.toString("yyMMdd_HHmmss"),  # Reverse notation date-time
+        cur_date_time.strftime("%d-%m-%Y"),  # Date
+        cur_date_time.strftime("%H:%M:%S"),  # Time
+        cur_date_time.strftime("%y%m%d_%H%M%S"),  # Reverse notation date-time
     )
 
 
@@ -91,17 +101,253 @@ def get_current_date_time():
 class State(object):
     """Reflects the actual readings, parsed into separate variables, of the
     Arduino. There should only be one instance of the State class.
+
+    The heater power is a snapshot of the power supply reading, taken at the
+    same DAQ update as the Arduino readings. That way the charts, the GUI and
+    the log file all show the same value, even though the power supply is
+    being read out concurrently in its own thread.
     """
 
     def __init__(self):
-        self.time = np.nan  # [s]
-        self.dht22_temp = np.nan  # ['C]
-        self.dht22_humi = np.nan  # [%]
+        self.time = nan  # [s]
+        self.dht22_temp = nan  # ['C]
+        self.dht22_humi = nan  # [%]
+        self.heater_power = nan  # [W]
         self.pid_enabled = False  # PID controller
 
 
 state = State()
 
+# ------------------------------------------------------------------------------
+#   LogWriter
+# ------------------------------------------------------------------------------
+
+
+class LogWriter(QtCore.QThread):
+    """Dedicated thread owning the log file and performing all disk I/O on it,
+    i.e. opening, writing, flushing, rotating and closing, so that the DAQ
+    thread never has to wait on the disk. Data put into queue `q` gets
+    collected in memory and is written out once every `LOG_FLUSH_INTERVAL`
+    seconds, or sooner when `LOG_BUFFER_SIZE` characters have piled up or when
+    a command is received.
+
+    Queue commands:
+        (OPEN, filepath, mode): Close the current log file and open a new one
+        CLOSE : Close the current log file
+        FLUSH : Write out all collected data right away
+        ROTATE: Rotate the current log file, see `BufferedFileLogger`
+        STOP  : Close the current log file and stop the thread
+
+    Every command first writes out all data collected so far to the current
+    log file. By design, disk errors are reported to the command line and the
+    thread continues on. An exception escaping `run()` would abort the whole
+    application.
+    """
+
+    OPEN = object()
+    CLOSE = object()
+    FLUSH = object()
+    ROTATE = object()
+    STOP = object()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setObjectName("LOG")  # For DEBUG info
+
+        self.q = queue.Queue()
+        self._filepath = None
+        self._filehandle = None
+        self._buffer = []
+        self._buffer_size = 0  # [chars]
+
+    def run(self):
+        tick_flush = time.perf_counter()  # [s]
+
+        while True:
+            try:
+                item = self.q.get(timeout=LOG_FLUSH_INTERVAL)
+            except queue.Empty:
+                item = None
+
+            now = time.perf_counter()
+            if isinstance(item, str):
+                self._buffer.append(item)
+                self._buffer_size += len(item)
+
+            elif item is not None:
+                self._write_out()
+                tick_flush = now
+
+                if isinstance(item, tuple) and item[0] is self.OPEN:
+                    self._close()
+                    self._open(filepath=item[1], mode=item[2])
+                elif item is self.CLOSE or item is self.STOP:
+                    self._close()
+                elif item is self.ROTATE:
+                    self._rotate()
+
+            if (
+                self._buffer_size > LOG_BUFFER_SIZE
+                or now - tick_flush >= LOG_FLUSH_INTERVAL
+            ):
+                self._write_out()
+                tick_flush = now
+
+            if item is not None:
+                self.q.task_done()
+            if item is self.STOP:
+                break
+
+    def stop(self):
+        """Write out all remaining data, close the log file and wait for the
+        thread to finish. Blocks the calling thread until done.
+        """
+        self.q.put(self.STOP)
+        self.wait()
+
+    def _open(self, filepath, mode: str) -> bool:
+        self._filepath = filepath
+        try:
+            self._filehandle = open(filepath, mode)
+        except Exception as err:
+            pft(err, 3)
+            self._filehandle = None
+            return False
+        else:
+            return True
+
+    def _close(self):
+        if self._filehandle is not None:
+            try:
+                self._filehandle.close()
+            except Exception as err:
+                pft(err, 3)
+
+        self._filepath = None
+        self._filehandle = None
+        self._buffer.clear()
+        self._buffer_size = 0
+
+    def _write_out(self):
+        """Write all collected data to the log file and flush it to disk.
+        """
+        if not self._buffer:
+            return
+
+        if self._filehandle is None:
+            # The log file could not be (re)opened before. Retry, keeping the
+            # data in memory until it succeeds. No file means no recording.
+            if self._filepath is None or not self._open(self._filepath, "a"):
+                return
+
+        try:
+            self._filehandle.write("".join(self._buffer))
+            self._filehandle.flush()
+        except Exception as err:
+            pft(err, 3)
+
+        self._buffer.clear()
+        self._buffer_size = 0
+
+    def _rotate(self):
+        """When any of the renames fails, e.g. because another program holds
+        one of the backup files open, the rotation is skipped and the current
+        log file is appended to instead. The repeated header will then show up
+        in the middle of the current log file.
+        """
+        if self._filehandle is None:
+            return
+
+        filepath = self._filepath
+        self._close()
+        try:
+            for i in range(LOG_BACKUP_COUNT - 1, 0, -1):
+                backup = "%s.%i" % (filepath, i)
+                if os.path.exists(backup):
+                    os.replace(backup, "%s.%i" % (filepath, i + 1))
+            os.replace(filepath, "%s.1" % filepath)
+        except Exception as err:
+            pft(err, 3)
+            self._open(filepath, "a")
+        else:
+            self._open(filepath, "w")
+
+
+# ------------------------------------------------------------------------------
+#   BufferedFileLogger
+# ------------------------------------------------------------------------------
+
+
+class BufferedFileLogger(FileLogger):
+    """FileLogger that does not touch the disk in the thread calling
+    `update()`, `write()` or `close()`. Instead, the log file is owned by its
+    own `LogWriter` thread, which must be started with `writer.start()` and
+    stopped with `writer.stop()`. Creating and closing the log file are
+    queued as commands for the writer thread, which guarantees that data
+    ends up in the file that was open at the time the data got written.
+
+    Consequently, a failure to open the log file can not be reported back to
+    `update()`. It is reported to the command line by the writer thread
+    instead, while the recording continues to run.
+
+    The log file is rotated once it grows beyond `LOG_MAX_SIZE` characters,
+    similar to `logging.handlers.RotatingFileHandler`: The full file gets
+    renamed to `<filepath>.1`, older ones shift up to `<filepath>.2` and so on
+    up to `LOG_BACKUP_COUNT`, and a fresh file starting with the header is
+    opened at `<filepath>`. Note that the size limit is approximate: it counts
+    characters, not bytes, and non-ASCII characters like those in the header
+    take up more than one byte on disk.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self._size = 0  # [chars] written to the current log file
+        self.writer = LogWriter()
+
+    def __del__(self):
+        pass  # The log file is owned and closed by `self.writer`
+
+    def _create_log(self) -> bool:
+        self._size = 0
+        self.writer.q.put_nowait((LogWriter.OPEN, self._filepath, self._mode))
+        return True
+
+    def write(self, data) -> bool:
+        """Only accepts ASCII data of type `str`, as the log file is opened in
+        text mode.
+
+        Returns True if successful, False otherwise.
+        """
+        if not isinstance(data, str):
+            pft("Can only write `str` to the log, got `%s`." % type(data), 3)
+            return False
+
+        if self._size + len(data) > LOG_MAX_SIZE:
+            self._size = 0
+            self.writer.q.put_nowait(LogWriter.ROTATE)
+            if self._write_header_function is not None:
+                self._write_header_function()
+
+        self._size += len(data)
+        self.writer.q.put_nowait(data)
+        return True
+
+    def flush(self):
+        self.writer.q.put_nowait(LogWriter.FLUSH)
+
+    def close(self):
+        # Not calling `super().close()`, because the file handle is owned by
+        # the writer thread
+        if self._is_recording:
+            self.writer.q.put_nowait(LogWriter.CLOSE)
+
+        self._size = 0
+        self._start = False
+        self._stop = False
+        self._is_recording = False
+
+
 # ------------------------------------------------------------------------------
 #   MainWindow
 # ------------------------------------------------------------------------------
@@ -258,6 +504,7 @@ class MainWindow(QtWid.QWidget):
         self.plots = [self.pi_temp, self.pi_humi, self.pi_power]
         for plot in self.plots:
             plot.setClipToView(True)
+            plot.setDownsampling(auto=True, mode="peak")
             plot.showGrid(x=1, y=1)
             plot.setLabel("bottom", text="history (s)", **p)
             plot.setMenuEnabled(True)
@@ -291,6 +538,10 @@ class MainWindow(QtWid.QWidget):
             self.tscurve_power,
         ]
 
+        # Readings (time, temperature, humidity, power) appended by the DAQ
+        # thread, waiting to be moved into the curves by `update_chart()`
+        self.chart_readings = deque()
+
         #  Group `Readings`
         # -------------------------
 
@@ -405,6 +656,7 @@ class MainWindow(QtWid.QWidget):
     @QtCore.pyqtSlot(bool)
     def process_qpbt_pid_enabled(self, state_):
         state.pid_enabled = state_
+        self.qpbt_pid_enabled.setText("PID ON" if state_ else "PID OFF")
         qdev_psu.V_source.setReadOnly(state_)
         qdev_psu.I_source.setReadOnly(state_)
 
@@ -419,7 +671,7 @@ class MainWindow(QtWid.QWidget):
 
         MIN_SETP = 25  # ['C]
         MAX_SETP = 40  # ['C]
-        temp_setp = np.clip(temp_setp, MIN_SETP, MAX_SETP)
+        temp_setp = max(MIN_SETP, min(temp_setp, MAX_SETP))
         self.qlin_pid_temp_setp.setText("%.1f" % temp_setp)
         pid.setpoint = temp_setp
 
@@ -432,7 +684,7 @@ class MainWindow(QtWid.QWidget):
         except:
             raise
 
-        pid_Kp = np.clip(pid_Kp, 0, 10)
+        pid_Kp = max(0, min(pid_Kp, 10))
         self.qlin_pid_Kp.setText("%.1f" % pid_Kp)
         pid.set_tunings(pid_Kp, pid.ki, pid.kd)
 
@@ -445,7 +697,7 @@ class MainWindow(QtWid.QWidget):
         except:
             raise
 
-        pid_Ki = np.clip(pid_Ki, 0, 1)
+        pid_Ki = max(0, min(pid_Ki, 1))
         self.qlin_pid_Ki.setText("%.0e" % pid_Ki)
         pid.set_tunings(pid.kp, pid_Ki, pid.kd)
 
@@ -459,44 +711,70 @@ class MainWindow(QtWid.QWidget):
             raise
 
         V_CLAMP_MAX = 18  # [V]
-        V_clamp = np.clip(V_clamp, 0, V_CLAMP_MAX)
+        V_clamp = max(0, min(V_clamp, V_CLAMP_MAX))
         self.qlin_pid_V_clamp.setText("%.1f" % V_clamp)
         pid.set_output_limits(0, V_clamp)
 
+    @staticmethod
+    def set_text(widget, text: str):
+        """Only pass the text on to the widget when it differs from the current
+        text. `QLabel` and `QAbstractButton` already ignore an unchanged text
+        themselves, but `QLineEdit.setText()` does not and would reset its
+        cursor and trigger a repaint on every call.
+        """
+        if widget.text() != text:
+            widget.setText(text)
+
     @QtCore.pyqtSlot()
-    def update_GUI(self):
+    def update_clock(self):
         str_cur_date, str_cur_time, _ = get_current_date_time()
-        self.qlbl_cur_date_time.setText(
-            "%s    %s" % (str_cur_date, str_cur_time)
-        )
-        self.qlbl_update_counter.setText("%i" % qdev_ard.update_counter_DAQ)
-        self.qlbl_DAQ_rate.setText(
-            "DAQ: %.1f Hz" % qdev_ard.obtained_DAQ_rate_Hz
+        self.set_text(
+            self.qlbl_cur_date_time, "%s    %s" % (str_cur_date, str_cur_time)
         )
         if log.is_recording():
-            self.qlbl_recording_time.setText(log.pretty_elapsed())
-
-        self.qlin_dht22_temp.setText("%.2f" % state.dht22_temp)
-        self.qlin_dht22_humi.setText("%.1f" % state.dht22_humi)
-        self.qlin_power.setText("%.3f" % psu.state.P_meas)
-        self.qlbl_title.setText(
-            "Interior:  %.1f °C,  %.1f %%"
-            % (state.dht22_temp, state.dht22_humi)
+            self.set_text(self.qlbl_recording_time, log.pretty_elapsed())
+
+    @QtCore.pyqtSlot()
+    def update_GUI(self):
+        self.set_text(
+            self.qlbl_update_counter, "%i" % qdev_ard.update_counter_DAQ
+        )
+        self.set_text(
+            self.qlbl_DAQ_rate, "DAQ: %.1f Hz" % qdev_ard.obtained_DAQ_rate_Hz
+        )
+
+        self.set_text(self.qlin_dht22_temp, "%.2f" % state.dht22_temp)
+        self.set_text(self.qlin_dht22_humi, "%.1f" % state.dht22_humi)
+        self.set_text(self.qlin_power, "%.3f" % state.heater_power)
+        self.set_text(
+            self.qlbl_title, FMT_TITLE(state.dht22_temp, state.dht22_humi)
         )
 
         if state.pid_enabled:
             self.qpbt_pid_enabled.setChecked(True)
-            self.qpbt_pid_enabled.setText("PID ON")
-            qdev_psu.V_source.setText("%.3f" % pid.output)
+            self.set_text(self.qpbt_pid_enabled, "PID ON")
+            self.set_text(qdev_psu.V_source, "%.3f" % pid.output)
         else:
             self.qpbt_pid_enabled.setChecked(False)
-            self.qpbt_pid_enabled.setText("PID OFF")
+            self.set_text(self.qpbt_pid_enabled, "PID OFF")
 
     @QtCore.pyqtSlot()
     def update_chart(self):
         if DEBUG:
             tprint("update_chart")
 
+        # Move all readings collected by the DAQ thread into the curves, in a
+        # single batch per curve
+        readings = []
+        while self.chart_readings:
+            readings.append(self.chart_readings.popleft())
+
+        if readings:
+            t, temp, humi, power = zip(*readings)
+            self.tscurve_dht22_temp.extendData(t, temp)
+            self.tscurve_dht22_humi.extendData(t, humi)
+            self.tscurve_power.extendData(t, power)
+
         for tscurve in self.tscurves:
             tscurve.update()
 
@@ -511,10 +789,10 @@ def stop_running():
     qdev_ard.quit()
     qdev_psu.quit()
     log.close()
+    log.writer.stop()
 
     print("Stopping timers................ ", end="")
     timer_GUI.stop()
-    timer_charts.stop()
     print("done.")
 
 
@@ -550,69 +828,75 @@ def about_to_quit():
 
 
 def DAQ_function():
-    # Date-time keeping
-    str_cur_date, str_cur_time, str_cur_datetime = get_current_date_time()
-
-    # Query the Arduino for its state
-    success, tmp_state = ard.query_ascii_values("?", delimiter="\t")
+    # Query the Arduino for its state. We parse the raw reply ourselves,
+    # instead of using `query_ascii_values()`, to skip decoding the reply and
+    # parsing the Arduino time that we do not use.
+    success, reply = ard.query("?", returns_ascii=False)
     if not (success):
+        str_cur_date, str_cur_time, _ = get_current_date_time()
         dprint(
             "'%s' reports IOError @ %s %s"
             % (ard.name, str_cur_date, str_cur_time)
         )
         return False
 
-    # Parse readings into separate state variables
+    # Parse readings into separate state variables. The Arduino time is
+    # ignored, because we will use PC time instead.
     try:
-        (
-            state.time,
-            state.dht22_temp,
-            state.dht22_humi,
-            ds18b20_temp,
-        ) = tmp_state
-        state.time /= 1000  # Arduino time, [msec] to [s]
+        _, dht22_temp, dht22_humi, ds18b20_temp = reply.split(b"\t")
+        dht22_temp = float(dht22_temp)
+        dht22_humi = float(dht22_humi)
+        ds18b20_temp = float(ds18b20_temp)
     except Exception as err:
         pft(err, 3)
+        str_cur_date, str_cur_time, _ = get_current_date_time()
         dprint(
             "'%s' reports IOError @ %s %s"
             % (ard.name, str_cur_date, str_cur_time)
         )
         return False
 
+    state.time = time.perf_counter()
+    state.dht22_temp = dht22_temp
+    state.dht22_humi = dht22_humi
+    state.heater_power = psu.state.P_meas
+
     # Optional extra sensor to register the heater surface temperature
     # print("%.2f" % ds18b20_temp)
 
-    # We will use PC time instead
-    state.time = time.perf_counter()
-
-    # PID control
-    pid.set_mode(
-        mode=(
-            psu.state.ENA_output
-            and state.pid_enabled
-            and not np.isnan(state.dht22_temp)
-        ),
-        current_input=state.dht22_temp,
-        current_output=psu.state.V_source,
+    # PID control. The PID toggle button is tested first, so that the common
+    # case of a disabled PID short-circuits on a single attribute lookup.
+    pid_enabled = (
+        state.pid_enabled
+        and psu.state.ENA_output
+        and not isnan(state.dht22_temp)
     )
+    if pid_enabled != pid.in_auto:
+        pid.set_mode(
+            mode=pid_enabled,
+            current_input=state.dht22_temp,
+            current_output=psu.state.V_source,
+        )
 
+    # NOTE: Keep calling `compute()` even when the PID is disabled. It returns
+    # immediately in that case, but it keeps the PID clock running which is
+    # needed for a correct time step once the PID gets enabled again.
     if pid.compute(current_input=state.dht22_temp):
         # New PID output got computed -> send new voltage to PSU
         qdev_psu.send(qdev_psu.dev.set_V_source, pid.output)
 
         # Print debug info to the terminal
-        dprint(
-            "Tp=%7.3f   Ti=%7.3f   outp=%7.3f"
-            % (pid.pTerm, pid.iTerm, pid.output)
-        )
+        dprint(FMT_PID_DEBUG(pid.pTerm, pid.iTerm, pid.output))
 
-    # Add readings to chart histories
-    window.tscurve_dht22_temp.appendData(state.time, state.dht22_temp)
-    window.tscurve_dht22_humi.appendData(state.time, state.dht22_humi)
-    window.tscurve_power.appendData(state.time, psu.state.P_meas)
+    # Add readings to chart histories. Thread-safe without locking, as
+    # `deque.append()` is atomic.
+    window.chart_readings.append(
+        (state.time, state.dht22_temp, state.dht22_humi, state.heater_power)
+    )
 
-    # Logging to file
-    log.update(filepath=str_cur_datetime + ".txt", mode="w")
+    # Logging to file. The filename defaults to the date-time at which the
+    # recording got started and is only determined once at that moment.
+    log.update(mode="w")
 
     # Return success
     return True
@@ -628,8 +912,12 @@ def write_header_to_log():
 
 def write_data_to_log():
     log.write(
-        "%.1f\t%.2f\t%.1f\t%.3f\n"
-        % (log.elapsed(), state.dht22_temp, state.dht22_humi, psu.state.P_meas,)
+        FMT_LOG_DATA(
+            log.elapsed(),
+            state.dht22_temp,
+            state.dht22_humi,
+            state.heater_power,
+        )
     )
 
 
@@ -701,13 +989,14 @@ if __name__ == "__main__":
 
     # Connect signals
     qdev_ard.signal_DAQ_updated.connect(window.update_GUI)
+    qdev_ard.signal_DAQ_updated.connect(window.update_chart)
     qdev_ard.signal_connection_lost.connect(notify_connection_lost)
 
     # --------------------------------------------------------------------------
     #   File logger
     # --------------------------------------------------------------------------
 
-    log = FileLogger(
+    log = BufferedFileLogger(
         write_header_function=write_header_to_log,
         write_data_function=write_data_to_log,
     )
@@ -734,18 +1023,21 @@ if __name__ == "__main__":
     #   Timers
     # --------------------------------------------------------------------------
 
+    # The readings in the GUI and the charts are refreshed by
+    # `qdev_ard.signal_DAQ_updated`. This timer only has to keep the clock
+    # ticking. It polls faster than 1 Hz to prevent the displayed seconds from
+    # skipping, but the labels will only get repainted when their text
+    # actually changes.
     timer_GUI = QtCore.QTimer()
-    timer_GUI.timeout.connect(window.update_GUI)
+    timer_GUI.setTimerType(QtCore.Qt.PreciseTimer)
+    timer_GUI.timeout.connect(window.update_clock)
     timer_GUI.start(100)
 
-    timer_charts = QtCore.QTimer()
-    timer_charts.timeout.connect(window.update_chart)
-    timer_charts.start(CHART_INTERVAL_MS)
-
     # --------------------------------------------------------------------------
     #   Start the main GUI event loop
     # --------------------------------------------------------------------------
 
+    log.writer.start()
     qdev_ard.start()
     qdev_psu.start()
 